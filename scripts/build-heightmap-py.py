@@ -11,15 +11,32 @@ Usage:
   python3 scripts/build-heightmap-py.py
 """
 
+import hashlib
 import json
 import math
 import os
 import struct
 import sys
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 from PIL import Image
 
+try:
+    import imagecodecs
+except ImportError:  # optional: Pillow's PNG encoder is used instead
+    imagecodecs = None
+
+try:
+    import pyproj
+    from pyproj import Transformer
+except ImportError:  # optional: the built-in BNG → WGS84 transform is used instead
+    pyproj = None
+    Transformer = None
+
 # ─── Paths ──────────────────────────────────────────────────────────────────
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -33,6 +50,10 @@ TILE_W = os.path.join(SRC_DIR, "Copernicus_DSM_COG_10_N51_00_W001_00_DEM.tif")
 OUT_PNG = os.path.join(OUT_DIR, "london_full_height_u16.png")
 OUT_JSON = os.path.join(OUT_DIR, "london_full_height.json")
 
+# Cached grid → DEM sample positions (regenerated when the geometry changes)
+INDEX_CACHE = os.path.join(ROOT_DIR, "data", "terrain", "london_full_sample_indices.npz")
+INDEX_CACHE_VERSION = 1
+
 # ─── Output grid (British National Grid, EPSG:27700) ────────────────────────
 
 BNG_E_MIN = 490000
@@ -44,6 +65,14 @@ PIXEL_SIZE_M = 50  # 50m resolution → 1400 x 1000 pixels
 OUT_W = (BNG_E_MAX - BNG_E_MIN) // PIXEL_SIZE_M  # 1400
 OUT_H = (BNG_N_MAX - BNG_N_MIN) // PIXEL_SIZE_M  # 1000
 
+# DEM samples are held as int16 multiples of this step (±3276 m range).
+# The ±0.05 m rounding is far below the DEM's own few-metre vertical error.
+DEM_STEP_M = 0.1
+
+# Sample positions are computed in square blocks of this many pixels; at 128² each
+# float64 intermediate is 128 KB and stays in L2.
+BLOCK_SIZE = 128
+
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # BNG ↔ WGS84 coordinate transforms
@@ -75,96 +104,206 @@ HELM_RX = math.radians(0.1502 / 3600)
 HELM_RY = math.radians(0.2470 / 3600)
 HELM_RZ = math.radians(0.8421 / 3600)
 HELM_S = -20.4894e-6
+HELM_S1 = 1 + HELM_S
 
+# Meridional arc series coefficients for the Airy ellipsoid
+_AIRY_N = (AIRY_A - AIRY_B) / (AIRY_A + AIRY_B)
+_AIRY_N2 = _AIRY_N * _AIRY_N
+_AIRY_N3 = _AIRY_N2 * _AIRY_N
+_AIRY_N4 = _AIRY_N3 * _AIRY_N
+_MA_COEF = 1 + _AIRY_N + 5 / 4 * _AIRY_N2 + 5 / 4 * _AIRY_N3
+_MB_COEF = 3 * _AIRY_N + 3 * _AIRY_N2 + 21 / 8 * _AIRY_N3
+_MC_COEF = 15 / 8 * (_AIRY_N2 + _AIRY_N3)
+_MD_COEF = 35 / 24 * _AIRY_N3
+_B_F0 = AIRY_B * TM_F0
 
-def _meridional_arc(lat, a, b):
-    """Meridional arc from equator to latitude on an ellipsoid."""
-    n = (a - b) / (a + b)
-    n2 = n * n
-    n3 = n2 * n
-    Ma = (1 + n + 5 / 4 * n2 + 5 / 4 * n3) * (lat - TM_LAT0)
-    Mb = (3 * n + 3 * n2 + 21 / 8 * n3) * math.sin(lat - TM_LAT0) * math.cos(lat + TM_LAT0)
-    Mc = (15 / 8 * n2 + 15 / 8 * n3) * math.sin(2 * (lat - TM_LAT0)) * math.cos(2 * (lat + TM_LAT0))
-    Md = 35 / 24 * n3 * math.sin(3 * (lat - TM_LAT0)) * math.cos(3 * (lat + TM_LAT0))
-    return b * TM_F0 * (Ma - Mb + Mc - Md)
 
+def _meridional_arc(lat):
+    """Meridional arc on the Airy ellipsoid from the true origin to latitude."""
+    Ma = _MA_COEF * (lat - TM_LAT0)
+    Mb = _MB_COEF * np.sin(lat - TM_LAT0) * np.cos(lat + TM_LAT0)
+    Mc = _MC_COEF * np.sin(2 * (lat - TM_LAT0)) * np.cos(2 * (lat + TM_LAT0))
+    Md = _MD_COEF * np.sin(3 * (lat - TM_LAT0)) * np.cos(3 * (lat + TM_LAT0))
+    return _B_F0 * (Ma - Mb + Mc - Md)
 
-def bng_to_osgb36(E, N):
-    """Inverse Transverse Mercator: BNG easting/northing → OSGB36 lat/lon (radians)."""
-    a, b, e2 = AIRY_A, AIRY_B, AIRY_E2
 
-    # Iterate to find latitude
-    lat = TM_LAT0 + (N - TM_N0) / (a * TM_F0)
-    for _ in range(10):
-        M = _meridional_arc(lat, a, b)
-        lat = lat + (N - TM_N0 - M) / (a * TM_F0)
-        if abs(N - TM_N0 - _meridional_arc(lat, a, b)) < 1e-5:
-            break
+# Arc from the equator to TM_LAT0, and the footpoint latitude series in n
+_ARC0 = -float(_meridional_arc(0.0))
+_FP2 = 3 / 2 * _AIRY_N - 27 / 32 * _AIRY_N3
+_FP4 = 21 / 16 * _AIRY_N2 - 55 / 32 * _AIRY_N4
+_FP6 = 151 / 96 * _AIRY_N3
+_FP8 = 1097 / 512 * _AIRY_N4
 
-    sin_lat = math.sin(lat)
-    cos_lat = math.cos(lat)
-    tan_lat = math.tan(lat)
 
-    nu = a * TM_F0 / math.sqrt(1 - e2 * sin_lat ** 2)
-    rho = a * TM_F0 * (1 - e2) / (1 - e2 * sin_lat ** 2) ** 1.5
-    eta2 = nu / rho - 1
+def bng_to_osgb36(E, N):
+    """
+    Inverse Transverse Mercator: BNG easting/northing arrays → OSGB36 lat/lon (radians).
+    E and N broadcast against each other. Everything up to the expansion terms
+    depends on N alone, so an (h, 1) column of northings keeps that work per row.
+    """
+    a, e2 = AIRY_A, AIRY_E2
+
+    # Footpoint latitude in closed form: invert the meridional arc through the
+    # rectifying latitude mu, then apply the standard series in n.
+    mu = (N - TM_N0 + _ARC0) / (_B_F0 * _MA_COEF)
+    lat = (mu
+           + _FP2 * np.sin(2 * mu)
+           + _FP4 * np.sin(4 * mu)
+           + _FP6 * np.sin(6 * mu)
+           + _FP8 * np.sin(8 * mu))
+
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    t = np.tan(lat)
+
+    # Shared powers, computed once and reused by every expansion term
+    t2 = t * t
+    t4 = t2 * t2
+    t6 = t4 * t2
+    w = 1 - e2 * sin_lat * sin_lat
+    nu = a * TM_F0 / np.sqrt(w)
+    rho = nu * (1 - e2) / w
+    nu_rho = nu / rho
+    eta2 = nu_rho - 1
+    nu2 = nu * nu
+    nu3 = nu2 * nu
+    nu5 = nu3 * nu2
+    nu7 = nu5 * nu2
+    t_rho = t / rho
+    inv_cos = 1 / cos_lat
 
     # Terms for expansion
+    VII = t_rho / (2 * nu)
+    VIII = t_rho / (24 * nu3) * (5 + 3 * t2 + eta2 - 9 * t2 * eta2)
+    IX = t_rho / (720 * nu5) * (61 + 90 * t2 + 45 * t4)
+    X = inv_cos / nu
+    XI = inv_cos / (6 * nu3) * (nu_rho + 2 * t2)
+    XII = inv_cos / (120 * nu5) * (5 + 28 * t2 + 24 * t4)
+    XIIa = inv_cos / (5040 * nu7) * (61 + 662 * t2 + 1320 * t4 + 720 * t6)
+
+    # Evaluate both series in Horner form on dE², in place, so only the two
+    # output arrays are allocated at full grid size
     dE = E - TM_E0
-    VII = tan_lat / (2 * rho * nu)
-    VIII = tan_lat / (24 * rho * nu ** 3) * (5 + 3 * tan_lat ** 2 + eta2 - 9 * tan_lat ** 2 * eta2)
-    IX = tan_lat / (720 * rho * nu ** 5) * (61 + 90 * tan_lat ** 2 + 45 * tan_lat ** 4)
-    X = 1 / (cos_lat * nu)
-    XI = 1 / (6 * cos_lat * nu ** 3) * (nu / rho + 2 * tan_lat ** 2)
-    XII = 1 / (120 * cos_lat * nu ** 5) * (5 + 28 * tan_lat ** 2 + 24 * tan_lat ** 4)
-    XIIa = 1 / (5040 * cos_lat * nu ** 7) * (61 + 662 * tan_lat ** 2 + 1320 * tan_lat ** 4 + 720 * tan_lat ** 6)
-
-    out_lat = lat - VII * dE ** 2 + VIII * dE ** 4 - IX * dE ** 6
-    out_lon = TM_LON0 + X * dE - XI * dE ** 3 + XII * dE ** 5 - XIIa * dE ** 7
+    dE2 = dE * dE
+
+    out_lat = IX * dE2
+    np.subtract(VIII, out_lat, out=out_lat)
+    out_lat *= dE2
+    np.subtract(VII, out_lat, out=out_lat)
+    out_lat *= dE2
+    np.subtract(lat, out_lat, out=out_lat)
+
+    out_lon = XIIa * dE2
+    np.subtract(XII, out_lon, out=out_lon)
+    out_lon *= dE2
+    np.subtract(XI, out_lon, out=out_lon)
+    out_lon *= dE2
+    np.subtract(X, out_lon, out=out_lon)
+    out_lon *= dE
+    out_lon += TM_LON0
 
     return out_lat, out_lon
 
 
 def _cartesian(lat, lon, a, e2):
     """Geodetic → Cartesian (X, Y, Z)."""
-    sin_lat = math.sin(lat)
-    cos_lat = math.cos(lat)
-    nu = a / math.sqrt(1 - e2 * sin_lat ** 2)
-    X = nu * cos_lat * math.cos(lon)
-    Y = nu * cos_lat * math.sin(lon)
-    Z = nu * (1 - e2) * sin_lat
+    sin_lat = np.sin(lat)
+    nu = a / np.sqrt(1 - e2 * sin_lat ** 2)
+    r = nu * np.cos(lat)
+    X = r * np.cos(lon)
+    Y = np.multiply(r, np.sin(lon), out=r)
+    nu *= (1 - e2)
+    Z = np.multiply(nu, sin_lat, out=nu)
     return X, Y, Z
 
 
 def _geodetic(X, Y, Z, a, e2):
-    """Cartesian → Geodetic (lat, lon) using iterative method."""
-    lon = math.atan2(Y, X)
-    p = math.sqrt(X ** 2 + Y ** 2)
-    lat = math.atan2(Z, p * (1 - e2))
-    for _ in range(10):
-        nu = a / math.sqrt(1 - e2 * math.sin(lat) ** 2)
-        lat_new = math.atan2(Z + e2 * nu * math.sin(lat), p)
-        if abs(lat_new - lat) < 1e-12:
-            break
-        lat = lat_new
+    """Cartesian → Geodetic (lat, lon) using Bowring's closed-form solution."""
+    b = a * math.sqrt(1 - e2)
+    ep2 = e2 / (1 - e2)
+    lon = np.arctan2(Y, X)
+    p = np.hypot(X, Y)
+    theta = np.arctan2(Z * a, p * b)
+    sin_t = np.sin(theta)
+    cos_t = np.cos(theta)
+    lat = np.arctan2(Z + ep2 * b * sin_t ** 3, p - e2 * a * cos_t ** 3)
     return lat, lon
 
 
+def _affine3(t, cx, X, cy, Y, cz, Z, tmp):
+    """t + cx*X + cy*Y + cz*Z for scalar coefficients, reusing one scratch buffer."""
+    out = np.multiply(X, cx)
+    np.multiply(Y, cy, out=tmp)
+    out += tmp
+    np.multiply(Z, cz, out=tmp)
+    out += tmp
+    out += t
+    return out
+
+
 def osgb36_to_wgs84(lat_osgb, lon_osgb):
     """Helmert transform: OSGB36 lat/lon (radians) → WGS84 lat/lon (degrees)."""
     X1, Y1, Z1 = _cartesian(lat_osgb, lon_osgb, AIRY_A, AIRY_E2)
 
-    s1 = 1 + HELM_S
-    X2 = HELM_TX + s1 * X1 - HELM_RZ * Y1 + HELM_RY * Z1
-    Y2 = HELM_TY + HELM_RZ * X1 + s1 * Y1 - HELM_RX * Z1
-    Z2 = HELM_TZ - HELM_RY * X1 + HELM_RX * Y1 + s1 * Z1
+    # Each output axis is one row of the 3×3 Helmert matrix applied to the
+    # (X1, Y1, Z1) component arrays; the coefficients are scalars.
+    tmp = np.empty_like(X1)
+    X2 = _affine3(HELM_TX, HELM_S1, X1, -HELM_RZ, Y1, HELM_RY, Z1, tmp)
+    Y2 = _affine3(HELM_TY, HELM_RZ, X1, HELM_S1, Y1, -HELM_RX, Z1, tmp)
+    Z2 = _affine3(HELM_TZ, -HELM_RY, X1, HELM_RX, Y1, HELM_S1, Z1, tmp)
 
     lat_wgs, lon_wgs = _geodetic(X2, Y2, Z2, WGS84_A, WGS84_E2)
-    return math.degrees(lat_wgs), math.degrees(lon_wgs)
+    return np.degrees(lat_wgs), np.degrees(lon_wgs)
+
+
+_pyproj_local = threading.local()
+
+
+def _pyproj_transformer():
+    """Per-thread pyproj BNG → WGS84 transformer (PROJ contexts are not shared)."""
+    tf = getattr(_pyproj_local, "transformer", None)
+    if tf is None:
+        tf = Transformer.from_crs("EPSG:27700", "EPSG:4326", always_xy=True)
+        _pyproj_local.transformer = tf
+    return tf
+
+
+def transform_backend():
+    """Name of the BNG → WGS84 implementation in use."""
+    return "pyproj" if Transformer is not None else "built-in"
+
+
+def transform_signature():
+    """
+    Identify the BNG → WGS84 transform exactly enough to key cached results.
+    For pyproj the PROJ version and pipeline are included, plus the grid
+    corners pushed through it: PROJ may only settle on a pipeline (grid files,
+    network access) when it transforms, and that choice changes the output.
+    """
+    if Transformer is None:
+        return ("built-in",)
+    tf = _pyproj_transformer()
+    corners_e = np.array([BNG_E_MIN, BNG_E_MAX, BNG_E_MIN, BNG_E_MAX], dtype=np.float64)
+    corners_n = np.array([BNG_N_MIN, BNG_N_MIN, BNG_N_MAX, BNG_N_MAX], dtype=np.float64)
+    lon, lat = tf.transform(corners_e, corners_n)
+    probe = tuple(np.round(np.concatenate([lon, lat]), 9).tolist())
+    return ("pyproj", pyproj.proj_version_str, tf.definition, probe)
 
 
 def bng_to_wgs84(E, N):
-    """BNG easting/northing → WGS84 lat/lon (degrees)."""
+    """
+    BNG easting/northing arrays → WGS84 lat/lon arrays (degrees).
+    Uses PROJ through pyproj when it is installed, otherwise the built-in
+    inverse TM + Helmert chain above.
+    """
+    # Geodetic accuracy needs float64 throughout, whatever the caller passed.
+    # At least 1-d, so the in-place ufuncs below also work for scalar inputs
+    E = np.atleast_1d(np.asarray(E, dtype=np.float64))
+    N = np.atleast_1d(np.asarray(N, dtype=np.float64))
+    if Transformer is not None:
+        E, N = (np.ascontiguousarray(x) for x in np.broadcast_arrays(E, N))
+        lon, lat = _pyproj_transformer().transform(E, N)
+        return lat, lon
     lat_osgb, lon_osgb = bng_to_osgb36(E, N)
     return osgb36_to_wgs84(lat_osgb, lon_osgb)
 
@@ -173,9 +312,11 @@ def bng_to_wgs84(E, N):
 # TIFF reading — minimal parser for Copernicus DEM COG files
 # ═══════════════════════════════════════════════════════════════════════════════
 
-def read_geotiff(path):
+def read_geotiff(path, bounds=None):
     """
     Read a Copernicus DEM GeoTIFF as a float32 numpy array.
+    If bounds=(lon_min, lat_min, lon_max, lat_max) is given, only the window
+    covering those bounds (plus a bilinear margin) is kept.
     Returns (data, origin_lon, origin_lat, pixel_w, pixel_h).
     pixel_h is negative (north-up convention).
     """
@@ -201,6 +342,21 @@ def read_geotiff(path):
     pixel_w = pixel_scale[0]    # degrees per pixel (positive)
     pixel_h = -pixel_scale[1]   # negative = north-up
 
+    if bounds is not None:
+        # Pillow decodes these COGs as one libtiff strip, so the window is cut
+        # after decode; keeping a compact copy still frees the bulk of the tile.
+        lon_min, lat_min, lon_max, lat_max = bounds
+        h, w = data.shape
+        c0 = max(0, math.floor((lon_min - origin_lon) / pixel_w) - 1)
+        c1 = min(w, math.ceil((lon_max - origin_lon) / pixel_w) + 2)
+        r0 = max(0, math.floor((lat_max - origin_lat) / pixel_h) - 1)
+        r1 = min(h, math.ceil((lat_min - origin_lat) / pixel_h) + 2)
+        if c0 >= c1 or r0 >= r1:
+            raise ValueError(f"{path} does not overlap bounds {bounds}")
+        data = data[r0:r1, c0:c1].copy()
+        origin_lon += c0 * pixel_w
+        origin_lat += r0 * pixel_h
+
     print(f"  {os.path.basename(path)}: {data.shape[1]}x{data.shape[0]}, "
           f"origin=({origin_lon:.4f}, {origin_lat:.4f}), "
           f"pixel=({pixel_w:.6f}, {pixel_h:.6f}), "
@@ -209,41 +365,208 @@ def read_geotiff(path):
     return data, origin_lon, origin_lat, pixel_w, pixel_h
 
 
-def sample_bilinear(data, origin_lon, origin_lat, pixel_w, pixel_h, lon, lat):
-    """Bilinear interpolation sample from a georeferenced array."""
-    # Convert geographic coordinate to fractional pixel position
-    col_f = (lon - origin_lon) / pixel_w
-    row_f = (lat - origin_lat) / pixel_h
+def merge_tiles(tile_w, tile_e):
+    """
+    Join two horizontally adjacent tiles (as returned by read_geotiff) into
+    one georeferenced array, so sampling needs no per-pixel tile choice.
+    """
+    data_w, lon0_w, lat0_w, pw_w, ph_w = tile_w
+    data_e, lon0_e, lat0_e, pw_e, ph_e = tile_e
 
-    h, w = data.shape
-    col0 = int(math.floor(col_f))
-    row0 = int(math.floor(row_f))
-    col1 = col0 + 1
-    row1 = row0 + 1
+    lon_join = lon0_w + data_w.shape[1] * pw_w
+    if (data_w.shape[0] != data_e.shape[0]
+            or not math.isclose(pw_w, pw_e) or not math.isclose(ph_w, ph_e)
+            or abs(lat0_w - lat0_e) > 0.01 * abs(ph_w)
+            or abs(lon0_e - lon_join) > 0.01 * pw_w):
+        raise ValueError("DEM tiles are not edge-aligned neighbours: "
+                         f"W ends at lon {lon_join:.6f}, E starts at {lon0_e:.6f}")
 
-    # Clamp to valid range
-    col0 = max(0, min(w - 1, col0))
-    col1 = max(0, min(w - 1, col1))
-    row0 = max(0, min(h - 1, row0))
-    row1 = max(0, min(h - 1, row1))
+    data = np.concatenate([data_w, data_e], axis=1)
+    return data, lon0_w, lat0_w, pw_w, ph_w
 
-    # Fractional parts
-    u = col_f - math.floor(col_f)
-    v = row_f - math.floor(row_f)
 
-    # Bilinear blend
-    val = (data[row0, col0] * (1 - u) * (1 - v) +
-           data[row0, col1] * u * (1 - v) +
-           data[row1, col0] * (1 - u) * v +
-           data[row1, col1] * u * v)
+def quantize_dem(data):
+    """Round float elevations (m) to int16 multiples of DEM_STEP_M."""
+    limit = np.iinfo(np.int16).max
+    q = np.rint(data / DEM_STEP_M)
+    np.clip(q, -limit, limit, out=q)
+    return q.astype(np.int16)
 
-    return float(val)
+
+def bilinear_indices(shape, origin_lon, origin_lat, pixel_w, pixel_h, lon, lat):
+    """
+    Bilinear sample positions in a georeferenced array of the given shape.
+    Returns (row0, col0, u, v): the top-left corner indices as int16 and the
+    fractional offsets as float16. Positions beyond the edge are clamped onto
+    it, so the border pixels replicate.
+    """
+    h, w = shape
+    col_f = ((lon - origin_lon) / pixel_w).astype(np.float32)
+    row_f = ((lat - origin_lat) / pixel_h).astype(np.float32)
+    np.clip(col_f, 0, w - 1, out=col_f)
+    np.clip(row_f, 0, h - 1, out=row_f)
+
+    # Positions are non-negative after the clamp, so truncation is floor
+    col0 = col_f.astype(np.int16)
+    row0 = row_f.astype(np.int16)
+    col_f -= col0
+    row_f -= row0
+    return row0, col0, col_f.astype(np.float16), row_f.astype(np.float16)
+
+
+def gather_bilinear(data, row0, col0, u, v, scale=1.0):
+    """
+    Blend the four corners around each (row0, col0) by weights (u, v).
+    Corners are upcast to float32 as they are gathered and the result is
+    multiplied by scale.
+    """
+    h, w = data.shape
+    col0 = col0.astype(np.intp)
+    row0 = row0.astype(np.intp)
+    u = u.astype(np.float32)
+    v = v.astype(np.float32)
+
+    # Turn (row, col) pairs into flat offsets; the +1 neighbours stop at the edge
+    dc = (col0 < w - 1).astype(np.intp)
+    dr = np.where(row0 < h - 1, w, 0)
+    row0 *= w
+    i00 = row0
+    i00 += col0
+    i01 = i00 + dc
+    i10 = i00 + dr
+    i11 = i10 + dc
+
+    # Four corner gathers from the flattened array, blended as two lerps
+    flat = data.ravel()
+    top = flat.take(i00).astype(np.float32)
+    top += u * (flat.take(i01) - top)
+    bottom = flat.take(i10).astype(np.float32)
+    bottom += u * (flat.take(i11) - bottom)
+    bottom -= top
+    bottom *= v
+    top += bottom
+    if scale != 1.0:
+        top *= np.float32(scale)
+    return top
 
 
 # ═══════════════════════════════════════════════════════════════════════════════
 # Main pipeline
 # ═══════════════════════════════════════════════════════════════════════════════
 
+def grid_bounds_wgs84():
+    """
+    WGS84 (lon_min, lat_min, lon_max, lat_max) of the output pixel centres.
+    The transform is monotonic over the grid, so the outer ring of pixels
+    is enough to bound it.
+    """
+    bng_e = BNG_E_MIN + (np.arange(OUT_W) + 0.5) * PIXEL_SIZE_M
+    bng_n = BNG_N_MAX - (np.arange(OUT_H) + 0.5) * PIXEL_SIZE_M
+    ring_e = np.concatenate([bng_e, bng_e, np.full(OUT_H, bng_e[0]), np.full(OUT_H, bng_e[-1])])
+    ring_n = np.concatenate([np.full(OUT_W, bng_n[0]), np.full(OUT_W, bng_n[-1]), bng_n, bng_n])
+    lat, lon = bng_to_wgs84(ring_e, ring_n)
+    return float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())
+
+
+def _block_indices(tile, r0, c0, indices):
+    """Transform one block of the output grid and store its sample positions."""
+    bh, bw = indices[0][r0:r0 + BLOCK_SIZE, c0:c0 + BLOCK_SIZE].shape
+    bng_e = BNG_E_MIN + (np.arange(c0, c0 + bw) + 0.5) * PIXEL_SIZE_M
+    bng_n = BNG_N_MAX - (np.arange(r0, r0 + bh) + 0.5) * PIXEL_SIZE_M
+    # Northings as a column, eastings as a row: the footpoint latitude terms
+    # are then solved once per row and broadcast along it
+    lat, lon = bng_to_wgs84(bng_e[np.newaxis, :], bng_n[:, np.newaxis])
+    data, origin_lon, origin_lat, pixel_w, pixel_h = tile
+    block = bilinear_indices(data.shape, origin_lon, origin_lat, pixel_w, pixel_h, lon, lat)
+    for full, part in zip(indices, block):
+        full[r0:r0 + bh, c0:c0 + bw] = part
+
+
+def compute_sample_indices(tile):
+    """
+    Sample positions of every output pixel in the tile, as full-grid
+    (row0, col0, u, v) arrays from bilinear_indices.
+    """
+    # Work in BLOCK_SIZE² blocks so every intermediate array stays cache-sized.
+    # Blocks are independent and write disjoint slices, so they run on a
+    # thread pool; NumPy releases the GIL inside its ufunc loops.
+    # Image convention: row 0 = north (BNG_N_MAX), row H-1 = south (BNG_N_MIN)
+    indices = (np.empty((OUT_H, OUT_W), dtype=np.int16),
+               np.empty((OUT_H, OUT_W), dtype=np.int16),
+               np.empty((OUT_H, OUT_W), dtype=np.float16),
+               np.empty((OUT_H, OUT_W), dtype=np.float16))
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(_block_indices, tile, r0, c0, indices)
+                   for r0 in range(0, OUT_H, BLOCK_SIZE)
+                   for c0 in range(0, OUT_W, BLOCK_SIZE)]
+        n_blocks = len(futures)
+        step = math.ceil(n_blocks / 10)
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if done % step == 0 or done == n_blocks:
+                print(f"  Block {done}/{n_blocks} ({100 * done / n_blocks:.0f}%)")
+    return indices
+
+
+def _geometry_key(tile):
+    """Fingerprint of everything the sample positions depend on."""
+    data, origin_lon, origin_lat, pixel_w, pixel_h = tile
+    geometry = (INDEX_CACHE_VERSION, transform_signature(),
+                BNG_E_MIN, BNG_N_MAX, PIXEL_SIZE_M, OUT_W, OUT_H,
+                data.shape, origin_lon, origin_lat, pixel_w, pixel_h)
+    return hashlib.sha1(repr(geometry).encode()).hexdigest()
+
+
+def _save_sample_indices(key, indices):
+    """
+    Write the cache to a temp file and rename it into place, so an
+    interrupted run never leaves a truncated INDEX_CACHE behind.
+    """
+    cache_dir = os.path.dirname(INDEX_CACHE)
+    os.makedirs(cache_dir, exist_ok=True)
+    row0, col0, u, v = indices
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez_compressed(f, key=key, row0=row0, col0=col0, u=u, v=v)
+        os.replace(tmp_path, INDEX_CACHE)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def build_heightmap(tile):
+    """
+    Resample a DEM tile onto the BNG output grid.
+    The tile is a (data, origin_lon, origin_lat, pixel_w, pixel_h) tuple whose
+    data has been through quantize_dem. Returns a float32 (OUT_H, OUT_W) array
+    in metres.
+    """
+    # The grid → DEM mapping only depends on geometry, so it is cached on disk
+    # and later runs skip straight to the gather.
+    key = _geometry_key(tile)
+    indices = None
+    if os.path.exists(INDEX_CACHE):
+        try:
+            with np.load(INDEX_CACHE) as cached:
+                if str(cached["key"]) == key:
+                    indices = (cached["row0"], cached["col0"], cached["u"], cached["v"])
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f"  Ignoring unreadable cache {INDEX_CACHE}: {e}")
+        if indices is not None:
+            print(f"  Reusing sample positions from {INDEX_CACHE}")
+    if indices is None:
+        indices = compute_sample_indices(tile)
+        _save_sample_indices(key, indices)
+        print(f"  Cached sample positions: {INDEX_CACHE}")
+
+    output = gather_bilinear(tile[0], *indices, scale=DEM_STEP_M)
+
+    # Clamp negative elevations to 0 (sea level)
+    np.maximum(output, 0, out=output)
+    return output
+
+
 def main():
     print("=== London Full Heightmap Generator ===\n")
 
@@ -254,48 +577,31 @@ def main():
             print(f"ERROR: Source tile not found: {p}")
             sys.exit(1)
 
-    data_e, lon0_e, lat0_e, pw_e, ph_e = read_geotiff(TILE_E)
-    data_w, lon0_w, lat0_w, pw_w, ph_w = read_geotiff(TILE_W)
+    # Only the part of each tile under the output grid is kept
+    bounds = grid_bounds_wgs84()
+    print(f"  Grid bounds: lon [{bounds[0]:.4f}, {bounds[2]:.4f}], "
+          f"lat [{bounds[1]:.4f}, {bounds[3]:.4f}]")
+    data_e, lon0_e, lat0_e, pw_e, ph_e = read_geotiff(TILE_E, bounds)
+    data_w, lon0_w, lat0_w, pw_w, ph_w = read_geotiff(TILE_W, bounds)
 
-    # Tiles should cover lon -1° to 1°, lat 51° to 52°
+    # Tiles cover lon -1° to 1°, lat 51° to 52°; the windows straddle lon 0
     # W tile: lon -1 to 0, E tile: lon 0 to 1
     print(f"\n  W tile: lon [{lon0_w:.1f}, {lon0_w + data_w.shape[1] * pw_w:.1f}]")
     print(f"  E tile: lon [{lon0_e:.1f}, {lon0_e + data_e.shape[1] * pw_e:.1f}]")
+    data, lon0, lat0, pw, ph = merge_tiles((data_w, lon0_w, lat0_w, pw_w, ph_w),
+                                           (data_e, lon0_e, lat0_e, pw_e, ph_e))
+    del data_w, data_e
+    tile = (quantize_dem(data), lon0, lat0, pw, ph)
+    del data
 
     # 2. Build output grid
     print(f"\nOutput grid: {OUT_W}x{OUT_H} pixels, {PIXEL_SIZE_M}m resolution")
     print(f"BNG bounds: E [{BNG_E_MIN}, {BNG_E_MAX}], N [{BNG_N_MIN}, {BNG_N_MAX}]")
 
-    # Pre-compute WGS84 coordinates for every output pixel
-    # Image convention: row 0 = north (BNG_N_MAX), row H-1 = south (BNG_N_MIN)
-    print("\nConverting BNG grid to WGS84...")
-    output = np.zeros((OUT_H, OUT_W), dtype=np.float32)
-
-    total_pixels = OUT_W * OUT_H
-    sampled = 0
-
-    for row in range(OUT_H):
-        # BNG northing: top of image = north = max northing
-        bng_n = BNG_N_MAX - (row + 0.5) * PIXEL_SIZE_M
-        for col in range(OUT_W):
-            bng_e = BNG_E_MIN + (col + 0.5) * PIXEL_SIZE_M
-
-            lat, lon = bng_to_wgs84(bng_e, bng_n)
-
-            # Sample from the appropriate tile
-            if lon < 0:
-                elev = sample_bilinear(data_w, lon0_w, lat0_w, pw_w, ph_w, lon, lat)
-            else:
-                elev = sample_bilinear(data_e, lon0_e, lat0_e, pw_e, ph_e, lon, lat)
-
-            # Clamp negative elevations to 0 (sea level)
-            output[row, col] = max(0.0, elev)
-            sampled += 1
-
-        if (row + 1) % 100 == 0:
-            print(f"  Row {row + 1}/{OUT_H} ({100 * (row + 1) / OUT_H:.0f}%)")
+    print(f"\nConverting BNG grid to WGS84 ({transform_backend()}) and sampling DEM...")
+    output = build_heightmap(tile)
 
-    print(f"\nSampled {sampled} pixels")
+    print(f"\nSampled {OUT_W * OUT_H} pixels")
     elev_min = float(output.min())
     elev_max = float(output.max())
     elev_mean = float(output.mean())
@@ -319,12 +625,22 @@ def main():
     # 4. Encode to 16-bit PNG
     print("\nEncoding 16-bit PNG...")
     scale = 65535.0 / (elev_max - elev_min) if elev_max > elev_min else 1.0
-    u16 = ((output - elev_min) * scale).clip(0, 65535).astype(np.uint16)
+    # Rescale in place: output is not needed again once it is encoded
+    output -= elev_min
+    output *= scale
+    np.clip(output, 0, 65535, out=output)
+    u16 = output.astype("<u2")
+    del output
 
-    # Pillow 13+ deprecates mode= kwarg; use Image.fromarray with explicit dtype
-    img_out = Image.fromarray(u16)
     os.makedirs(OUT_DIR, exist_ok=True)
-    img_out.save(OUT_PNG)
+    if imagecodecs is not None:
+        # libpng via imagecodecs writes 16-bit greyscale faster than Pillow
+        with open(OUT_PNG, "wb") as f:
+            f.write(imagecodecs.png_encode(u16, level=6))
+    else:
+        # Hand Pillow the raw little-endian buffer directly as a 16-bit greyscale image
+        img_out = Image.frombuffer("I;16", (OUT_W, OUT_H), u16, "raw", "I;16", 0, 1)
+        img_out.save(OUT_PNG, compress_level=6)
     file_size = os.path.getsize(OUT_PNG)
     print(f"  Written: {OUT_PNG} ({file_size / 1024 / 1024:.1f} MB)")
 